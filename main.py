@@ -1,17 +1,19 @@
 import json
 import logging
-import time
 import os
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
 from typing import Dict
+from urllib.parse import urlsplit
 
+import orjson
 import requests
 from google.cloud import bigquery
 from google.cloud import secretmanager
 from google.cloud import storage
 from google.cloud.exceptions import BadRequest
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, Asm
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential, before_sleep_log
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential, wait_exponential_jitter, before_sleep_log
+from urllib3.util.retry import Retry
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
 
@@ -25,13 +27,21 @@ TEST_MODE = os.getenv("TEST_MODE").lower() in ['true', '1', 't', 'y', 'yes']
 TEST_EMAIL = os.getenv("TEST_EMAIL")
 FIDELITY = os.getenv("FIDELITY").lower() in ['true', '1', 't', 'y', 'yes']
 
+TINY_GERAR_NOTA_FISCAL_URL = "https://api.tiny.com.br/api2/gerar.nota.fiscal.pedido.php"
+TINY_OBTER_LINK_NOTA_FISCAL_URL = "https://api.tiny.com.br/api2/nota.fiscal.obter.link.php"
+TINY_PESQUISAR_CONTATOS_URL = "https://api.tiny.com.br/api2/contatos.pesquisa.php"
+TINY_API_TIMEOUT = (3.05, 30)
+EMAIL_LOOKUP_MAX_BYTES_BILLED = 1024 ** 3
+EMAIL_LOOKUP_HEDGE_SECONDS = 2
+
 
 storage_client = storage.Client()
 secret_manager_client = secretmanager.SecretManagerServiceClient()
 bq_client = bigquery.Client()
+executor = ThreadPoolExecutor(max_workers=6)
 
-TINY_ERP_API_TOKEN = ""
-SENDGRID_API_TOKEN = ""
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=0)))
 
 
 def get_api_token(secret_name: str) -> str:
@@ -44,11 +54,11 @@ def get_api_token(secret_name: str) -> str:
         raise
 
 
-def initialize_globals():
-    """Initialize global variables that require API calls."""
-    global TINY_ERP_API_TOKEN, SENDGRID_API_TOKEN
-    TINY_ERP_API_TOKEN = get_api_token(SECRET_MANAGER_API_TOKEN_NAME)
-    SENDGRID_API_TOKEN = get_api_token(SECRET_MANAGER_SENDGRID_API_KEY_NAME)
+TINY_ERP_API_TOKEN, SENDGRID_API_TOKEN = executor.map(
+    get_api_token, [SECRET_MANAGER_API_TOKEN_NAME, SECRET_MANAGER_SENDGRID_API_KEY_NAME]
+)
+
+sg_client = None
 
 
 class ValidationError(Exception):
@@ -63,32 +73,41 @@ class RetryableError(Exception):
     pass
 
 
-def trigger_function(event, context):
-    initialize_globals()
+def get_sg_client():
+    """Returns the shared SendGrid client, importing sendgrid and creating it on first use."""
+    global sg_client
+    if sg_client is None:
+        from sendgrid import SendGridAPIClient
+        sg_client = SendGridAPIClient(SENDGRID_API_TOKEN)
+    return sg_client
+
 
+def trigger_function(event, context):
     file_name = event['name']
     bucket_name = event['bucket']
     logging.info(f"Processing file: {file_name} from bucket: {bucket_name}")
 
-    sg_client = SendGridAPIClient(SENDGRID_API_TOKEN)
-
     file_data = download_blob(bucket_name, file_name)
     if file_data:
-        process_webhook_payload(json.loads(file_data), sg_client)
+        try:
+            payload = orjson.loads(file_data)
+        except orjson.JSONDecodeError:
+            payload = json.loads(file_data)
+        process_webhook_payload(payload)
 
 
-def download_blob(bucket_name: str, source_blob_name: str) -> str:
-    """Downloads a blob from the bucket."""
+def download_blob(bucket_name: str, source_blob_name: str) -> bytes:
+    """Downloads a blob from the bucket as raw bytes, which orjson parses without a decode step."""
     try:
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(source_blob_name)
-        return blob.download_as_string()
+        return blob.download_as_bytes()
     except Exception as e:
         logging.error(f"Failed to download blob {source_blob_name} from bucket {bucket_name}: {e}")
         raise
 
 
-def process_webhook_payload(payload: Dict, sg_client):
+def process_webhook_payload(payload: Dict):
     try:
         if 'dados' not in payload:
             logging.error("Payload missing 'dados' key.")
@@ -99,19 +118,20 @@ def process_webhook_payload(payload: Dict, sg_client):
             logging.error("Missing 'dados.id' in payload.")
             return
 
+        # Issued before touching any client field: the invoice must not depend on optional client data.
         try:
             nfce_id = generate_nfce(dados_id)
         except Exception as e:
             logging.error(f"Error during NFCe generation: {e}")
             nfce_id = None
 
-        cliente_info = payload['dados'].get('cliente', {})
+        cliente_info = payload['dados'].get('cliente') or {}
         cliente_nome = cliente_info.get('nome', 'Unknown Client')
-        cliente_cpfCnpj = cliente_info.get('cpfCnpj')
+        cliente_cpfCnpj = str(cliente_info.get('cpfCnpj') or '').strip()
 
         logging.info(f"Cliente Nome: {cliente_nome}, CPF/CNPJ: {cliente_cpfCnpj}")
 
-        if cliente_cpfCnpj is None:
+        if not cliente_cpfCnpj:
             logging.warning(f"NFCe was emitted for {cliente_nome}, but CPF/CNPJ is missing. No email will be sent.")
             return
 
@@ -120,17 +140,22 @@ def process_webhook_payload(payload: Dict, sg_client):
             logging.warning(f"No email found for {cliente_nome} with CPF/CNPJ: {cliente_cpfCnpj}. NFCe was emitted, but no email will be sent.")
             return
 
-        nota_fiscal_url = None
+        nota_fiscal_future = executor.submit(get_nota_fiscal_link, nfce_id) if nfce_id else None
 
-        if nfce_id:
-            try:
-                nota_fiscal_url = get_nota_fiscal_link(nfce_id)
-            except Exception as e:
-                logging.error(f"Error fetching NFCe link: {e}")
+        try:
+            email_data = aggregate_email_data(cliente_cpfCnpj, dados_id, client_email, cliente_nome)
+        finally:
+            nota_fiscal_url = None
+            if nota_fiscal_future:
+                try:
+                    nota_fiscal_url = nota_fiscal_future.result()
+                except Exception as e:
+                    logging.error(f"Error fetching NFCe link: {e}")
 
-        email_data = aggregate_email_data(cliente_cpfCnpj, dados_id, client_email, nota_fiscal_url, cliente_nome)
+        if nota_fiscal_url is not None:
+            email_data['nota_fiscal_url'] = nota_fiscal_url
 
-        send_email(email_data, sg_client)
+        send_email(email_data)
 
     except KeyError as e:
         logging.error(f"Key error in payload processing: {e}")
@@ -139,21 +164,30 @@ def process_webhook_payload(payload: Dict, sg_client):
 
 
 @retry(wait=wait_exponential(multiplier=2.5, min=30, max=187.5), stop=stop_after_attempt(4), retry=retry_if_exception_type((requests.exceptions.RequestException, RetryableError)))
-def make_api_call(url: str) -> Dict:
-    """Makes an API call with retry logic, URL sanitization, and enhanced error handling, using logging for error messages."""
+def make_api_call(url: str, params: Dict) -> Dict:
+    """Makes a Tiny ERP API call with retry logic and enhanced error handling, keeping the token out of the logs."""
     try:
-        sanitized_url = url.split('?token=')[0]
-        logging.info(f"Making API call to: {sanitized_url}")
+        logging.info(f"Making API call to: {urlsplit(url).path}")
 
-        response = requests.get(url)
+        query_params = {'token': TINY_ERP_API_TOKEN, 'formato': 'JSON', **params}
+        response = http_session.get(url, params=query_params, timeout=TINY_API_TIMEOUT, stream=False)
         response.raise_for_status()
-        json_data = response.json()
+        try:
+            json_data = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            # orjson rejects a BOM, NaN and non-UTF-8 bodies; requests decodes with the response charset.
+            try:
+                json_data = response.json()
+            except ValueError as e:
+                raise RetryableError(f"API response is not valid JSON: {e}")
 
         validate_json_payload(json_data)
 
         return json_data
     except requests.exceptions.RequestException as e:
-        logging.error(f"API request failed: {e}")
+        # str(e) carries the full request URL, token included, so only log what identifies the failure.
+        status_code = e.response.status_code if e.response is not None else None
+        logging.error(f"API request to {urlsplit(url).path} failed: {type(e).__name__} (status code: {status_code})")
         raise
     except ValidationError as e:
         logging.error(f"Payload validation failed: {e}")
@@ -183,10 +217,7 @@ def validate_json_payload(json_data: Dict):
 def generate_nfce(dados_id: str) -> str:
     """Generates NFCe for the given dados_id and returns idNotafiscal."""
     logging.info(f"Starting NFC-e generation for dados_id: {dados_id}")
-    token = TINY_ERP_API_TOKEN
-    url = f"https://api.tiny.com.br/api2/gerar.nota.fiscal.pedido.php?token={token}&formato=JSON&id={dados_id}&modelo=NFCe"
-
-    response = make_api_call(url)
+    response = make_api_call(TINY_GERAR_NOTA_FISCAL_URL, {'id': dados_id, 'modelo': 'NFCe'})
 
     if 'retorno' in response and 'registros' in response['retorno'] and 'registro' in response['retorno']['registros']:
         nfce_id = response['retorno']['registros']['registro']['idNotaFiscal']
@@ -198,10 +229,7 @@ def generate_nfce(dados_id: str) -> str:
 
 def get_nota_fiscal_link(idNotafiscal: str) -> str:
     logging.info(f"Fetching Nota Fiscal link for idNotafiscal: {idNotafiscal}")
-    token = TINY_ERP_API_TOKEN
-    url = f"https://api.tiny.com.br/api2/nota.fiscal.obter.link.php?token={token}&formato=JSON&id={idNotafiscal}"
-
-    response = make_api_call(url)
+    response = make_api_call(TINY_OBTER_LINK_NOTA_FISCAL_URL, {'id': idNotafiscal})
     logging.debug(f"API call made to fetch Nota Fiscal link for idNotafiscal: {idNotafiscal}")
 
     if 'retorno' in response and 'link_nfe' in response['retorno']:
@@ -213,12 +241,10 @@ def get_nota_fiscal_link(idNotafiscal: str) -> str:
         raise ValidationError("Nota Fiscal link response is missing expected fields.")
 
 
-def get_client_email_from_tinyerp(cliente_cpfCnpj: str) -> str:
+def get_client_email_from_tinyerp(cliente_cpfCnpj: str, single_attempt: bool = False) -> str:
     logging.info(f"Fetching email for client with CPF/CNPJ from TinyERP: {cliente_cpfCnpj}")
-    token = TINY_ERP_API_TOKEN
-    url = f"https://api.tiny.com.br/api2/contatos.pesquisa.php?token={token}&formato=JSON&cpf_cnpj={cliente_cpfCnpj}"
-
-    response = make_api_call(url)
+    api_call = make_api_call.retry_with(stop=stop_after_attempt(1)) if single_attempt else make_api_call
+    response = api_call(TINY_PESQUISAR_CONTATOS_URL, {'cpf_cnpj': cliente_cpfCnpj})
     logging.debug(f"API call made to fetch client email from TinyERP for CPF/CNPJ: {cliente_cpfCnpj}")
 
     contatos = response.get('retorno', {}).get('contatos', [])
@@ -236,33 +262,35 @@ def get_client_email_from_tinyerp(cliente_cpfCnpj: str) -> str:
     return None
 
 
-def get_client_email(cliente_cpfCnpj: str) -> str:
-    logging.info(f"Fetching email for client with CPF/CNPJ: {cliente_cpfCnpj}")
+def get_client_email_from_bigquery(cliente_cpfCnpj: str) -> str:
+    logging.info(f"Fetching email for client with CPF/CNPJ from BigQuery: {cliente_cpfCnpj}")
     try:
-        query = f"""
+        query = """
         SELECT email
         FROM `emporio-zingaro.z316_tiny.z316-tiny-contatos`
-        WHERE cpf_cnpj = '{cliente_cpfCnpj}'
+        WHERE cpf_cnpj = @cpf
+          AND email IS NOT NULL
+          AND email != ''
+        LIMIT 1
         """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("cpf", "STRING", cliente_cpfCnpj)],
+            maximum_bytes_billed=EMAIL_LOOKUP_MAX_BYTES_BILLED
+        )
         logging.debug("Constructed SQL query for client email.")
         logging.debug(f"SQL Query: {query}")
 
         logging.debug("Executing BigQuery query for client email.")
-        query_job = bq_client.query(query)
-        logging.debug("Waiting for query job to complete...")
-        results = query_job.result()
-        logging.debug("Query job completed.")
+        results = bq_client.query_and_wait(query, job_config=job_config)
+        logging.debug("Query completed.")
 
-        email_found = False
         for row in results:
             if row.email:
-                email_found = True
                 logging.info(f"Email found: {row.email}")
                 return row.email
 
-        if not email_found:
-            logging.warning(f"No email found in BigQuery for client with CPF/CNPJ: {cliente_cpfCnpj}. Falling back to TinyERP.")
-            return get_client_email_from_tinyerp(cliente_cpfCnpj)
+        logging.warning(f"No email found in BigQuery for client with CPF/CNPJ: {cliente_cpfCnpj}")
+        return None
 
     except BadRequest as e:
         logging.error(f"BigQuery BadRequest Error while fetching email for client {cliente_cpfCnpj}: {e}")
@@ -272,26 +300,56 @@ def get_client_email(cliente_cpfCnpj: str) -> str:
         raise
 
 
+def get_client_email(cliente_cpfCnpj: str) -> str:
+    """Looks the email up in BigQuery, racing TinyERP against it when BigQuery misses or is slow."""
+    logging.info(f"Fetching email for client with CPF/CNPJ: {cliente_cpfCnpj}")
+    bigquery_future = executor.submit(get_client_email_from_bigquery, cliente_cpfCnpj)
+    try:
+        email = bigquery_future.result(timeout=EMAIL_LOOKUP_HEDGE_SECONDS)
+        if email:
+            return email
+        logging.warning(f"Falling back to TinyERP for client with CPF/CNPJ: {cliente_cpfCnpj}")
+        return get_client_email_from_tinyerp(cliente_cpfCnpj)
+    except FuturesTimeoutError:
+        logging.info(f"BigQuery email lookup still running after {EMAIL_LOOKUP_HEDGE_SECONDS}s. Querying TinyERP concurrently.")
+    except Exception as e:
+        logging.warning(f"BigQuery email lookup failed, falling back to TinyERP for client with CPF/CNPJ {cliente_cpfCnpj}: {e}")
+        return get_client_email_from_tinyerp(cliente_cpfCnpj)
+
+    # Single attempt only: a lookup that loses the race must not keep a worker busy with tenacity backoff.
+    tinyerp_future = executor.submit(get_client_email_from_tinyerp, cliente_cpfCnpj, single_attempt=True)
+    error = None
+    for future in as_completed([bigquery_future, tinyerp_future]):
+        try:
+            email = future.result()
+        except Exception as e:
+            error = e
+            continue
+        if email:
+            return email
+
+    if error:
+        raise error
+    return None
+
+
 @retry(wait=wait_exponential(multiplier=30, min=30, max=90),
        stop=stop_after_attempt(4),
        before_sleep=before_sleep_log(logging, logging.INFO))
 def get_purchase_details(dados_id: str) -> dict:
     logging.info(f"Fetching purchase details for dados_id: {dados_id}")
 
-    query = f"""
+    query = """
     SELECT
-      item.id AS item_id,
       item.descricao AS item_name,
       item.quantidade AS item_quantity,
       item.valor AS item_price,
       (item.quantidade * item.valor) AS total_item_price,
       sub.desconto AS total_discount,
       sub.totalVenda AS total_paid,
-      sub.formaPagamento AS payment_method,
-      SUM(item.quantidade * item.valor) OVER() AS sub_total
+      sub.formaPagamento AS payment_method
     FROM (
       SELECT
-        id,
         desconto,
         totalVenda,
         formaPagamento,
@@ -299,43 +357,44 @@ def get_purchase_details(dados_id: str) -> dict:
       FROM
         `emporio-zingaro.z316_tiny_raw_json.pdv`
       WHERE
-        id = {dados_id}
+        id = @dados_id
     ) AS sub
     CROSS JOIN
       UNNEST(sub.itens) AS item
     """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("dados_id", "INT64", int(dados_id))]
+    )
 
     try:
         logging.debug("Constructed SQL query for purchase details.")
         logging.debug(f"SQL Query: {query}")
 
         logging.debug(f"Executing BigQuery query for purchase details.")
-        query_job = bq_client.query(query)
-        logging.debug("Waiting for query job to complete...")
-        results = query_job.result()
-        logging.debug("Query job completed.")
+        results = bq_client.query_and_wait(query, job_config=job_config)
+        logging.debug("Query completed.")
 
-        items = []
-        purchase_summary = {}
-        for row in results:
-            item_detail = {
+        rows = list(results)
+        if not rows:
+            logging.warning(f"No purchase details found for ID: {dados_id}. Data might be delayed or ID is incorrect.")
+            raise Exception("Purchase details not found after retries.")
+
+        items = [
+            {
                 'item_name': row.item_name,
                 'item_quantity': row.item_quantity,
                 'item_price': row.item_price,
                 'total_item_price': row.total_item_price
             }
-            items.append(item_detail)
-
-            purchase_summary.update({
-                'total_discount': row.total_discount,
-                'total_paid': row.total_paid,
-                'payment_method': row.payment_method,
-                'sub_total': row.sub_total
-            })
-
-        if not items:
-            logging.warning(f"No purchase details found for ID: {dados_id}. Data might be delayed or ID is incorrect.")
-            raise Exception("Purchase details not found after retries.")
+            for row in rows
+        ]
+
+        purchase_summary = {
+            'total_discount': rows[0].total_discount,
+            'total_paid': rows[0].total_paid,
+            'payment_method': rows[0].payment_method,
+            'sub_total': sum(item['total_item_price'] or 0 for item in items)
+        }
 
         logging.info(f"Items details: {items}")
         logging.info(f"Purchase summary for dados_id {dados_id}: {purchase_summary}")
@@ -351,172 +410,86 @@ def get_purchase_details(dados_id: str) -> dict:
         raise
 
 
-def get_daily_checkins(cliente_cpfCnpj: str) -> dict:
+def get_fidelity_stats(cliente_cpfCnpj: str) -> dict:
     if not FIDELITY:
-        return {'daily_checkins': 0}
-
-    logging.info(f"Fetching daily check-ins for client with CPF/CNPJ: {cliente_cpfCnpj}")
-    try:
-        query = f"""
-        SELECT
-          COUNT(DISTINCT FORMAT_DATE('%Y-%m-%d', data)) AS daily_checkins
-        FROM
-          `emporio-zingaro.z316_tiny_raw_json.pdv`
-        WHERE
-          contato.cpfCnpj = '{cliente_cpfCnpj}'
-          AND EXTRACT(QUARTER FROM data) = EXTRACT(QUARTER FROM CURRENT_DATE())
-          AND EXTRACT(YEAR FROM data) = EXTRACT(YEAR FROM CURRENT_DATE());
-        """
-        logging.debug("Constructed SQL query for daily check-ins.")
-        logging.debug(f"SQL Query: {query}")
+        return {'daily_checkins': 0, 'quarter_spend': 0, 'total_spend': 0}
 
-        logging.debug("Executing BigQuery query for daily check-ins.")
-        query_job = bq_client.query(query)
-        logging.debug("Waiting for query job to complete...")
-        results = query_job.result()
-        logging.debug("Query job completed.")
+    logging.info(f"Fetching fidelity stats for client with CPF/CNPJ: {cliente_cpfCnpj}")
 
-        row = next(iter(results), None)
-        daily_checkins = row.daily_checkins if row else 0
-
-        logging.info(f"Daily check-ins fetched: {daily_checkins} for client {cliente_cpfCnpj}")
-    except BadRequest as e:
-        logging.error(f"BigQuery BadRequest Error while fetching daily check-ins for client {cliente_cpfCnpj}: {e}")
-        daily_checkins = 0
-    except Exception as e:
-        logging.error(f"Error fetching daily check-ins for client {cliente_cpfCnpj}: {e}")
-        daily_checkins = 0
-
-    return {'daily_checkins': daily_checkins}
-
-
-def get_quarter_spend(cliente_cpfCnpj: str) -> dict:
-    if not FIDELITY:
-        return {'quarter_spend': 0}
-
-    logging.info(f"Fetching quarter spend for client with CPF/CNPJ: {cliente_cpfCnpj}")
-    try:
-        query = f"""
-        SELECT
-          SUM(sub.totalVenda) AS quarter_spend
-        FROM (
-          SELECT
-            pdv.totalVenda,
-            ARRAY_LENGTH(ARRAY(
-              SELECT AS STRUCT item
-              FROM UNNEST(pdv.itens) item
-              WHERE item.desconto = '0.00'
-            )) AS no_discount_items_count,
-            ARRAY_LENGTH(pdv.itens) AS total_items_count
-          FROM
-            `emporio-zingaro.z316_tiny_raw_json.pdv` AS pdv
-          WHERE
-            pdv.contato.cpfCnpj = '{cliente_cpfCnpj}'
-            AND EXTRACT(QUARTER FROM pdv.data) = EXTRACT(QUARTER FROM CURRENT_DATE())
-            AND EXTRACT(YEAR FROM pdv.data) = EXTRACT(YEAR FROM CURRENT_DATE())
-            AND pdv.formaPagamento IN ('credito', 'debito', 'pix', 'multiplas', 'dinheiro')
+    query = """
+    WITH quarter_metrics AS (
+      SELECT
+        COUNT(DISTINCT FORMAT_DATE('%Y-%m-%d', pdv.data)) AS daily_checkins,
+        SUM(IF(
+          pdv.formaPagamento IN ('credito', 'debito', 'pix', 'multiplas', 'dinheiro')
             AND pdv.desconto IN ('0', '0,00')
-        ) AS sub
-        WHERE
-          sub.no_discount_items_count = sub.total_items_count;
-        """
-        logging.debug("Constructed SQL query for quarter spend.")
-        logging.debug(f"SQL Query: {query}")
-
-        logging.debug("Executing BigQuery query for quarter spend.")
-        query_job = bq_client.query(query)
-        logging.debug("Waiting for query job to complete...")
-        results = query_job.result()
-        logging.debug("Query job completed.")
-
-        quarter_spend = next((row.quarter_spend for row in results), 0)
-        logging.info(f"Quarter spend fetched: {quarter_spend} for client {cliente_cpfCnpj}")
-
-    except BadRequest as e:
-        logging.error(f"BigQuery BadRequest Error while fetching quarter spend for client {cliente_cpfCnpj}: {e}")
-        quarter_spend = 0
-    except Exception as e:
-        logging.error(f"Error fetching quarter spend for client {cliente_cpfCnpj}: {e}")
-        quarter_spend = 0
-
-    return {'quarter_spend': quarter_spend}
-
-
-def get_lifetime_spend(cliente_cpfCnpj: str) -> dict:
-    if not FIDELITY:
-        return {'total_spend': 0}
-
-    logging.info(f"Fetching lifetime spend for client with CPF/CNPJ: {cliente_cpfCnpj}")
-
-    query = f"""
-    SELECT
-      SUM(sub.totalVenda) AS total_spend
-    FROM (
+            AND (SELECT COUNTIF(item.desconto = '0.00') FROM UNNEST(pdv.itens) item) = ARRAY_LENGTH(pdv.itens),
+          pdv.totalVenda,
+          0
+        )) AS quarter_spend
+      FROM
+        `emporio-zingaro.z316_tiny_raw_json.pdv` AS pdv
+      WHERE
+        pdv.contato.cpfCnpj = @cpf
+        AND pdv.data >= DATE_TRUNC(CURRENT_DATE(), QUARTER)
+        AND pdv.data < DATE_TRUNC(DATE_ADD(CURRENT_DATE(), INTERVAL 1 QUARTER), QUARTER)
+    ),
+    lifetime_metrics AS (
       SELECT
-        pdv.totalVenda,
-        ARRAY_LENGTH(ARRAY(
-          SELECT AS STRUCT item
-          FROM UNNEST(pdv.itens) item
-          WHERE item.desconto = '0.00'
-        )) AS no_discount_items_count,
-        ARRAY_LENGTH(pdv.itens) AS total_items_count
+        SUM(pdv.totalVenda) AS total_spend
       FROM
         `emporio-zingaro.z316_tiny_raw_json.pdv` AS pdv
       WHERE
-        pdv.contato.cpfCnpj = '{cliente_cpfCnpj}'
+        pdv.contato.cpfCnpj = @cpf
         AND pdv.data >= '2023-10-01'
         AND pdv.formaPagamento IN ('credito', 'debito', 'pix', 'multiplas', 'dinheiro')
         AND pdv.desconto IN ('0', '0,00')
-    ) AS sub
-    WHERE
-      sub.no_discount_items_count = sub.total_items_count;
+        AND (SELECT COUNTIF(item.desconto = '0.00') FROM UNNEST(pdv.itens) item) = ARRAY_LENGTH(pdv.itens)
+    )
+    SELECT
+      quarter_metrics.daily_checkins,
+      quarter_metrics.quarter_spend,
+      lifetime_metrics.total_spend
+    FROM
+      quarter_metrics
+    CROSS JOIN
+      lifetime_metrics
     """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("cpf", "STRING", cliente_cpfCnpj)]
+    )
 
-    logging.debug("Constructed SQL query for lifetime spend.")
+    logging.debug("Constructed SQL query for fidelity stats.")
     logging.debug(f"SQL Query: {query}")
 
     try:
-        logging.debug("Executing BigQuery query for lifetime spend.")
-        query_job = bq_client.query(query)
-
-        logging.debug("Waiting for query job to complete...")
-        query_job.result()
-        logging.debug("Query job completed.")
-
-        if query_job.state == "DONE" and not query_job.errors:
-            logging.info("Query executed successfully.")
-        else:
-            logging.error(f"Query job didn't finish successfully. State: {query_job.state}, Errors: {query_job.errors}")
+        logging.debug("Executing BigQuery query for fidelity stats.")
+        results = bq_client.query_and_wait(query, job_config=job_config)
+        logging.debug("Query completed.")
 
-        results = query_job.result()
-        rows = list(results)
-
-        logging.debug(f"Number of rows returned by the query: {len(rows)}")
-
-        if rows:
-            total_spend = next((row.total_spend for row in rows if row.total_spend is not None), 0)
-            logging.info(f"Total lifetime spend calculated: {total_spend}")
-        else:
-            total_spend = 0
-            logging.warning("Query returned no rows. Setting total_spend to 0.")
+        row = next(iter(results), None)
+        daily_checkins = row.daily_checkins if row and row.daily_checkins is not None else 0
+        quarter_spend = row.quarter_spend if row and row.quarter_spend is not None else 0
+        total_spend = row.total_spend if row and row.total_spend is not None else 0
 
+        logging.info(f"Fidelity stats fetched for client {cliente_cpfCnpj}: daily check-ins {daily_checkins}, quarter spend {quarter_spend}, lifetime spend {total_spend}")
     except BadRequest as e:
-        logging.error(f"BigQuery BadRequest Error while fetching lifetime spend for client {cliente_cpfCnpj}: {e}")
-        total_spend = 0
+        logging.error(f"BigQuery BadRequest Error while fetching fidelity stats for client {cliente_cpfCnpj}: {e}")
+        daily_checkins, quarter_spend, total_spend = 0, 0, 0
     except Exception as e:
-        logging.error(f"Unexpected error while fetching lifetime spend for client {cliente_cpfCnpj}: {e}")
-        total_spend = 0
+        logging.error(f"Unexpected error while fetching fidelity stats for client {cliente_cpfCnpj}: {e}")
+        daily_checkins, quarter_spend, total_spend = 0, 0, 0
 
-    logging.debug(f"Returning total_spend: {total_spend} for client {cliente_cpfCnpj}")
-    return {'total_spend': total_spend}
+    return {'daily_checkins': daily_checkins, 'quarter_spend': quarter_spend, 'total_spend': total_spend}
 
 
-def aggregate_email_data(cliente_cpfCnpj: str, dados_id: str, client_email: str, nota_fiscal_url: str, client_name: str) -> dict:
+def aggregate_email_data(cliente_cpfCnpj: str, dados_id: str, client_email: str, client_name: str) -> dict:
     try:
-        items = get_purchase_details(dados_id)
-        daily_checkins = get_daily_checkins(cliente_cpfCnpj) if FIDELITY else {'daily_checkins': 0}
-        quarter_spend = get_quarter_spend(cliente_cpfCnpj) if FIDELITY else {'quarter_spend': 0}
-        lifetime_spend = get_lifetime_spend(cliente_cpfCnpj) if FIDELITY else {'total_spend': 0}
+        purchase_future = executor.submit(get_purchase_details, dados_id)
+        fidelity_future = executor.submit(get_fidelity_stats, cliente_cpfCnpj)
+
+        items = purchase_future.result()
+        fidelity_stats = fidelity_future.result()
 
         email_data = {
             'client_email': client_email,
@@ -531,50 +504,44 @@ def aggregate_email_data(cliente_cpfCnpj: str, dados_id: str, client_email: str,
 
         if FIDELITY:
             email_data.update({
-                'daily_checkins': daily_checkins.get('daily_checkins', 0),
-                'quarter_spend': quarter_spend.get('quarter_spend', '0.00'),
-                'lifetime_spend': lifetime_spend.get('total_spend', '0.00'),
+                'daily_checkins': fidelity_stats.get('daily_checkins', 0),
+                'quarter_spend': fidelity_stats.get('quarter_spend', '0.00'),
+                'lifetime_spend': fidelity_stats.get('total_spend', '0.00'),
             })
 
-        if nota_fiscal_url is not None:
-            email_data['nota_fiscal_url'] = nota_fiscal_url
-
         return email_data
     except Exception as e:
         logging.error(f"Error aggregating email data for client {cliente_cpfCnpj} and ID {dados_id}: {e}")
         raise
 
 
-def send_email(email_data, sg_client, retry_count=0):
-    logging.info(f"Sending email with data: {email_data}")
-    try:
-        recipient_email = TEST_EMAIL if TEST_MODE else email_data.get('client_email')
-        if not recipient_email:
-            logging.warning(f"Email not sent. No email address for client {email_data.get('client_name')}.")
-            return
+@retry(wait=wait_exponential_jitter(initial=30, max=120),
+       stop=stop_after_attempt(3),
+       retry=retry_if_exception_type(Exception),
+       before_sleep=before_sleep_log(logging, logging.WARNING),
+       reraise=True)
+def send_email(email_data):
+    from sendgrid.helpers.mail import Asm, Email, Mail
 
-        sender_email = Email(FROM_EMAIL, FROM_NAME)
-        message = Mail(from_email=sender_email, to_emails=recipient_email)
-        message.template_id = TEMPLATE_ID
-        message.dynamic_template_data = email_data
+    logging.info(f"Sending email with data: {email_data}")
+    recipient_email = TEST_EMAIL if TEST_MODE else email_data.get('client_email')
+    if not recipient_email:
+        logging.warning(f"Email not sent. No email address for client {email_data.get('client_name')}.")
+        return
 
-        asm = Asm(group_id=23816, groups_to_display=[23816, 23831, 23817])
-        message.asm = asm
-        logging.debug(f"ASM settings applied with group ID {asm.group_id} and groups to display: {asm.groups_to_display}")
+    sender_email = Email(FROM_EMAIL, FROM_NAME)
+    message = Mail(from_email=sender_email, to_emails=recipient_email)
+    message.template_id = TEMPLATE_ID
+    message.dynamic_template_data = email_data
 
-        response = sg_client.send(message)
+    asm = Asm(group_id=23816, groups_to_display=[23816, 23831, 23817])
+    message.asm = asm
+    logging.debug(f"ASM settings applied with group ID {asm.group_id} and groups to display: {asm.groups_to_display}")
 
-        if response.status_code in range(200, 300):
-            logging.info(f"Email successfully sent to {recipient_email} on attempt {retry_count + 1}")
-        else:
-            logging.error(f"Failed to send email on attempt {retry_count + 1}: {response.status_code} | {response.body}")
-            raise Exception("Email sending failed")
+    response = get_sg_client().send(message)
 
-    except Exception as e:
-        if retry_count < 2:
-            wait_time = 2 ** (retry_count + 1) * 30
-            logging.warning(f"Retrying to send email to {recipient_email}. Retry count: {retry_count + 1}. Waiting for {wait_time} seconds. Error: {e}")
-            time.sleep(wait_time)
-            send_email(email_data, sg_client, retry_count + 1)
-        else:
-            logging.error(f"Max retry attempts reached for sending email to {recipient_email}. Error: {e}")
+    if response.status_code in range(200, 300):
+        logging.info(f"Email successfully sent to {recipient_email}")
+    else:
+        logging.error(f"Failed to send email to {recipient_email}: {response.status_code} | {response.body}")
+        raise Exception("Email sending failed")